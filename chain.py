@@ -1,3 +1,27 @@
+import argparse
+import copy
+import json
+import sys
+import time
+import threading
+import types
+import weakref
+
+from collections import OrderedDict, namedtuple
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+try:
+    string_types = (basestring, )
+except NameError:
+    string_types = (str, )
+
+# Old style classes only exist in python2
+class_types = (type, getattr(types, 'ClassType', type))
+
 class ChainAPI(object):
     """Decorator to set certain options on a function"""
     def __init__(self, bypass=False, allowed=True):
@@ -19,6 +43,222 @@ class ChainAPI(object):
         
         return func
 
+def deferrable(func):
+    """Mark a method on a proxy as safe to be buffered between chain_begin and chain_commit"""
+    func.deferrable = True
+    return func
+
+def old_value(obj, key, missing):
+    """
+        Value to restore obj.key to if a commit fails, or missing if it should be deleted
+
+        Attributes that are only on the class are missing from the instance
+        and are deleted rather than copied onto the instance
+    """
+    if hasattr(getattr(type(obj), key, None), '__set__') or not hasattr(obj, '__dict__'):
+        return getattr(obj, key, missing)
+    return obj.__dict__.get(key, missing)
+
+def type_name(obj):
+    """Name of obj if it is a class, otherwise the name of it's class"""
+    if isinstance(obj, class_types):
+        return obj.__name__
+    return obj.__class__.__name__
+
+def step_name(internals):
+    """
+        Name of what internals is about to call
+
+        Methods on the internals are chain_<attr>, other methods and functions from the proxy are <type>.<attr>
+        and callable objects are <type>.__call__
+    """
+    current = internals.current
+    owner = getattr(current, '__self__', None)
+    name = getattr(current, '__name__', None)
+    if name is not None:
+        if owner is internals:
+            return "chain_%s" % name
+        elif owner is None or isinstance(owner, types.ModuleType):
+            # current_key is only kept while current is still what was accessed on the proxy
+            key = internals.current_key
+            if key is not None and not key.startswith("chain_"):
+                return "%s.%s" % (type_name(internals.proxy), key)
+            return name
+        return "%s.%s" % (type_name(owner), name)
+    elif current is not None:
+        return "%s.__call__" % current.__class__.__name__
+    return internals.current_key
+
+def profiled(profiler, name, func):
+    """Return a function that calls func through the profiler as the step with this name"""
+    def call(*args, **kwargs):
+        return profiler.call(name, func, *args, **kwargs)
+    return call
+
+# Whether a value is callable and what chain flags it has
+Description = namedtuple("Description"
+    , ["callable", "keep_current", "bypass_chain", "not_allowed_from_chain", "deferrable"]
+    )
+
+# Descriptions of attributes on types, filled in by describe_type as they are needed
+# Types are weakly referenced so this doesn't keep types alive that are otherwise gone
+type_descriptions = weakref.WeakKeyDictionary()
+
+def describe(value):
+    """Return a Description of value"""
+    try:
+        return Description(
+              callable = callable(value)
+            , keep_current = bool(getattr(value, 'keep_current', False))
+            , bypass_chain = bool(getattr(value, 'bypass_chain', False))
+            , not_allowed_from_chain = bool(getattr(value, 'not_allowed_from_chain', False))
+            , deferrable = bool(getattr(value, 'deferrable', False))
+            )
+    except Exception:
+        return describe(None)
+
+def describe_attribute(obj, name):
+    """Return a Description of obj.name, treating attributes that can't be accessed as None"""
+    try:
+        value = getattr(obj, name)
+    except Exception:
+        value = None
+    return describe(value)
+
+def type_version(kind):
+    """Something that changes when attributes are added to or removed from kind or it's bases"""
+    return tuple(len(vars(base)) for base in getattr(kind, '__mro__', (kind, )))
+
+class TypeDescriptions(object):
+    """Names from dir on a type, with Descriptions that are only worked out when they are asked for"""
+    def __init__(self, kind):
+        # Doesn't hold onto kind so type_descriptions can still let go of it
+        self.version = type_version(kind)
+        self.names = frozenset(dir(kind))
+        self.described = {}
+    
+    def describe(self, kind, name):
+        """Return the Description of name on kind, remembering it for next time"""
+        if name not in self.described:
+            self.described[name] = describe_attribute(kind, name)
+        return self.described[name]
+
+def describe_type(kind):
+    """
+        Return TypeDescriptions for kind, remembering it for next time
+
+        It is made again if attributes have been added to or removed from the type since
+        Use forget_type if an existing attribute on the type is replaced
+    """
+    descriptions = type_descriptions.get(kind)
+    if descriptions is None or descriptions.version != type_version(kind):
+        descriptions = type_descriptions[kind] = TypeDescriptions(kind)
+    return descriptions
+
+def forget_type(kind):
+    """Forget what describe_type remembered about kind"""
+    type_descriptions.pop(kind, None)
+
+def uses_own_dir(obj):
+    """Whether what is on obj can't be worked out from it's type and __dict__"""
+    kind = type(obj)
+    return (
+           isinstance(obj, class_types)
+        or kind is not getattr(obj, '__class__', None)
+        or getattr(kind, '__dir__', None) is not getattr(object, '__dir__', None)
+        or not isinstance(getattr(obj, '__dict__', {}), dict)
+        )
+
+class Descriptions(Mapping):
+    """
+        Read only {prefix + name : Description} of everything on obj
+
+        Names are found whenever they are asked for, without accessing any attributes,
+        and each Description is only worked out when it is asked for.
+        Names on the type of obj are shared with every other instance of that type.
+    """
+    def __init__(self, obj, prefix=""):
+        self.obj = obj
+        self.prefix = prefix
+        self.described = {}
+    
+    def found(self):
+        """Return (TypeDescriptions or None, names only on this object)"""
+        obj = self.obj
+        if uses_own_dir(obj):
+            return None, set(dir(obj))
+        return describe_type(type(obj)), getattr(obj, '__dict__', {})
+    
+    def __getitem__(self, key):
+        if not key.startswith(self.prefix):
+            raise KeyError(key)
+        name = key[len(self.prefix):]
+        
+        on_type, on_obj = self.found()
+        if on_type is None:
+            if name not in on_obj:
+                raise KeyError(key)
+            if name not in self.described:
+                self.described[name] = describe_attribute(self.obj, name)
+            return self.described[name]
+        
+        if name in on_obj:
+            return describe(on_obj[name])
+        elif name in on_type.names:
+            return on_type.describe(type(self.obj), name)
+        raise KeyError(key)
+    
+    def __contains__(self, key):
+        if not key.startswith(self.prefix):
+            return False
+        name = key[len(self.prefix):]
+        on_type, on_obj = self.found()
+        return name in on_obj or (on_type is not None and name in on_type.names)
+    
+    def __iter__(self):
+        on_type, on_obj = self.found()
+        names = set(on_obj)
+        if on_type is not None:
+            names = names.union(on_type.names)
+        return iter([self.prefix + name for name in names])
+    
+    def __len__(self):
+        return len(list(iter(self)))
+
+class ChainView(object):
+    """
+        What can be accessed on a chain, as read only {name : Description} mappings
+
+        Both are only made when they are first accessed and find names whenever they are used.
+        Names and descriptions of attributes on types are shared between every view of that type
+    """
+    def __init__(self, internals, proxy):
+        self.proxy = proxy
+        self.internals = internals
+        self._commands = None
+        self._attributes = None
+    
+    @property
+    def commands(self):
+        """The chain_<attr> commands on the internals"""
+        if self._commands is None:
+            self._commands = Descriptions(self.internals, prefix="chain_")
+        return self._commands
+    
+    @property
+    def attributes(self):
+        """Attributes on the proxy"""
+        if self._attributes is None:
+            if not self.proxy:
+                self._attributes = {}
+            else:
+                self._attributes = Descriptions(self.proxy)
+        return self._attributes
+    
+    def names(self):
+        """Everything that can be accessed on the chain"""
+        return list(self.commands) + list(self.attributes)
+
 class ChainInternals(object):
     """Internal management for state of the chain"""
     def __init__(self, proxy=None, strict_proxy=True, **options):
@@ -32,6 +272,9 @@ class ChainInternals(object):
         self._last_current = None
         self.meaningful_current = False
         
+        self.view = None
+        self.pending = None
+        self.current_key = None
         self.proxy_stack = []
         self.stored_values = {}
         self.named_proxies = {}
@@ -67,6 +310,7 @@ class ChainInternals(object):
     
     @ChainAPI(allowed=False)
     def use(self, key):
+        self.current_key = key
         if key.startswith("chain_"):
             attr = getattr(self, key[6:])
             if hasattr(attr, 'not_allowed_from_chain') and attr.not_allowed_from_chain:
@@ -98,9 +342,27 @@ class ChainInternals(object):
     def call_current(self, *args, **kwargs):
         current = self.current
         if self.options['strict_proxy'] or current and callable(current):
-            result = current(*args, **kwargs)
+            profiler = self.options.get('profiler')
+            if self.pending is not None and hasattr(current, 'deferrable') and current.deferrable:
+                # Called when the transaction is committed instead
+                # Under the name it has now, as current changes before then
+                if profiler:
+                    current = profiled(profiler, step_name(self), current)
+                self.pending.append(('call', current, args, kwargs))
+                
+                # There is no result until commit, so the chain doesn't have a current value
+                self.current = None
+                self.current_key = None
+                return
+            
+            if profiler:
+                result = profiler.call(step_name(self), current, *args, **kwargs)
+            else:
+                result = current(*args, **kwargs)
             if not hasattr(current, 'keep_current') or not current.keep_current:
+                # The result didn't come from accessing current_key
                 self.current = result
+                self.current_key = None
             
             if hasattr(current, 'bypass_chain') and current.bypass_chain:
                 # Return a tuple, incase result of calling current is None
@@ -108,6 +370,13 @@ class ChainInternals(object):
                 # And ones that don't
                 return (result, )
     
+    @ChainAPI(bypass=True)
+    def introspect(self):
+        """Bypass chain and return a ChainView of what can be accessed on the chain"""
+        if self.view is None or self.view.proxy is not self.proxy:
+            self.view = ChainView(self, self.proxy)
+        return self.view
+    
     @ChainAPI(bypass=True)
     def exit(self):
         """Bypass chain and return all stored values"""
@@ -140,11 +409,13 @@ class ChainInternals(object):
         if value is None:
             value = self.current_value
         self.proxy = value
+        self.view = None
     
     @ChainAPI()
     def demote_value(self):
         """Remove current proxy and use previous proxy instead"""
         self.proxy = None
+        self.view = None
         if self.proxy_stack:
             self.proxy = self.proxy_stack.pop()
     
@@ -170,8 +441,78 @@ class ChainInternals(object):
     
     @ChainAPI()
     def setattr(self, key, value):
-        """Call setattr on the proxy with provided key and value"""
-        setattr(self.proxy, key, value)
+        """Call setattr on the proxy with provided key and value, or buffer it if in a transaction"""
+        if self.pending is not None:
+            self.pending.append(('setattr', self.proxy, key, value))
+        else:
+            setattr(self.proxy, key, value)
+            self.view = None
+    
+    @ChainAPI()
+    def begin(self):
+        """Start buffering setattrs and deferrable calls until commit"""
+        if self.pending is not None:
+            raise ValueError("Chain already has a transaction in progress")
+        self.pending = []
+    
+    @ChainAPI()
+    def rollback(self):
+        """Forget everything buffered since begin"""
+        self.pending = None
+    
+    @ChainAPI()
+    def commit(self):
+        """
+            Apply everything buffered since begin in the order it happened
+
+            Repeated setattrs of an attribute between deferred calls only apply the last one
+            If anything fails, the attributes that were already set are restored before the error is raised
+        """
+        if self.pending is None:
+            raise ValueError("Chain has no transaction to commit")
+        pending, self.pending = self.pending, None
+        
+        # Going backwards, forget what was set whenever we pass a call
+        # So calls still see every attribute set before them
+        seen = set()
+        operations = []
+        for operation in reversed(pending):
+            if operation[0] == 'setattr':
+                identity = (id(operation[1]), operation[2])
+                if identity in seen:
+                    continue
+                seen.add(identity)
+            else:
+                seen = set()
+            operations.append(operation)
+        operations.reverse()
+        
+        missing = object()
+        undo = []
+        committed = False
+        try:
+            for kind, target, first, second in operations:
+                if kind == 'setattr':
+                    old = old_value(target, first, missing)
+                    setattr(target, first, second)
+                    undo.append((target, first, old))
+                else:
+                    target(*first, **second)
+            committed = True
+        finally:
+            if not committed:
+                # The error from commit is raised after this regardless of any errors from undoing
+                for proxy, key, old in reversed(undo):
+                    try:
+                        if old is missing:
+                            delattr(proxy, key)
+                        else:
+                            setattr(proxy, key, old)
+                    except Exception:
+                        pass
+            
+            # Whatever happened, the proxies may have changed
+            self.view = None
 
 class Chain(object):
     """Exposed API for creating a chain to proxy some object"""
@@ -192,10 +533,223 @@ class Chain(object):
             return self
     
     def __dir__(self):
-        internals = object.__getattribute__(self, 'internals')
-        proxy = internals.proxy
-        result = ['chain_%s' % k for k in dir(internals)]
-        if proxy:
-            return result + dir(proxy)
+        return object.__getattribute__(self, 'internals').introspect().names()
+
+class ChainProfiler(object):
+    """
+        Records time spent in each step of any chain created with profiler=<this profiler>
+
+        Steps are named after the type of the proxy and the method being called,
+        and steps that happen inside other steps (i.e. from nested chains) are recorded under them.
+        Each thread keeps it's own stack of steps, so one profiler can be shared between threads.
+    """
+    def __init__(self, timer=None):
+        self.timer = timer or getattr(time, 'perf_counter', time.time)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.steps = {}
+        self.collapsed = {}
+    
+    @property
+    def stack(self):
+        """Steps currently being called in this thread as [name, time spent in steps under this one]"""
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+    
+    def call(self, name, func, *args, **kwargs):
+        """Call func with args and kwargs and record time spent as the step with this name"""
+        stack = self.stack
+        # Total time is only counted once for steps that recursively call themselves
+        outermost = name not in [n for n, _ in stack]
+        stack.append([name, 0])
+        start = self.timer()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = self.timer() - start
+            path = ";".join(n for n, _ in stack)
+            _, children = stack.pop()
+            caller = None
+            if stack:
+                caller = stack[-1][0]
+                stack[-1][1] += elapsed
+            self.record(name, caller, path, elapsed - children, elapsed, outermost)
+    
+    def record(self, name, caller, path, own, total, outermost=True):
+        """
+            Add a call to name from caller that took own time in itself and total time overall
+
+            Calls that aren't outermost are recursive, so their total time is already part of an outer call
+        """
+        primitive = 1 if outermost else 0
+        if not outermost:
+            total = 0
+        
+        with self.lock:
+            self.collapsed[path] = self.collapsed.get(path, 0) + own
+            
+            if name not in self.steps:
+                self.steps[name] = [0, 0, 0, 0, {}]
+            step = self.steps[name]
+            step[0] += 1
+            step[1] += primitive
+            step[2] += own
+            step[3] += total
+            
+            if caller is not None:
+                from_caller = step[4].setdefault(caller, [0, 0, 0, 0])
+                from_caller[0] += 1
+                from_caller[1] += primitive
+                from_caller[2] += own
+                from_caller[3] += total
+    
+    def create_stats(self):
+        """Create self.stats in the format cProfile uses so pstats.Stats(profiler) can be used"""
+        def key(name):
+            return ("chain", 0, name)
+        
+        self.stats = {}
+        for name, (calls, primitive, own, total, callers) in self.steps.items():
+            self.stats[key(name)] = (primitive, calls, own, total
+                , dict((key(caller), tuple(numbers)) for caller, numbers in callers.items())
+                )
+    
+    def write_collapsed(self, out):
+        """Write each stack of steps with the microseconds spent in it for use with flamegraph tools"""
+        for path in sorted(self.collapsed):
+            out.write("%s %d\n" % (path, int(self.collapsed[path] * 1000000)))
+
+class ChainScript(object):
+    """
+        Run chains described as json lists of steps against proxies made by proxy_factory
+
+        Each step is one of
+         * A string, which is accessed on the chain (i.e. a proxy attribute or a chain_ command)
+         * A list, which calls the chain with those positional arguments
+         * A dictionary of {"args" : [...], "kwargs" : {...}}, which calls the chain with those arguments
+    """
+    def __init__(self, proxy_factory, cache_size=256, **options):
+        self.options = options
+        self.cache_size = cache_size
+        self.proxy_factory = proxy_factory
+        self.parsed = OrderedDict()
+    
+    def parse(self, script):
+        """Return steps for a json string, reusing steps already parsed for an identical script"""
+        if script in self.parsed:
+            steps = self.parsed.pop(script)
         else:
-            return result
\ No newline at end of file
+            steps = json.loads(script)
+            if not isinstance(steps, list):
+                raise ValueError("Chain script must be a list of steps, got %r" % (steps, ))
+            steps = tuple(self.parse_step(step) for step in steps)
+        
+        # Most recently used scripts are kept at the end
+        # So the oldest is the first one to go when the cache is full
+        self.parsed[script] = steps
+        if len(self.parsed) > self.cache_size:
+            self.parsed.popitem(last=False)
+        return steps
+    
+    def parse_step(self, step):
+        """
+            Turn a single step into a ('use', key) or ('call', (args, kwargs)) pair
+
+            Calls with lists or dictionaries in their arguments are ('copy', (args, kwargs))
+            so that each run gets it's own copy of those arguments
+        """
+        if isinstance(step, list):
+            args, kwargs = tuple(step), {}
+        elif isinstance(step, dict):
+            unknown = set(step) - set(['args', 'kwargs'])
+            if unknown:
+                raise ValueError("Unknown keys in chain step %r: %s" % (step, ", ".join(sorted(unknown))))
+            
+            args = step.get('args', [])
+            kwargs = step.get('kwargs', {})
+            if not isinstance(args, list):
+                raise ValueError("args in chain step must be a list, got %r" % (args, ))
+            if not isinstance(kwargs, dict):
+                raise ValueError("kwargs in chain step must be an object, got %r" % (kwargs, ))
+            args = tuple(args)
+        elif isinstance(step, string_types):
+            return ('use', step)
+        else:
+            raise ValueError("Unknown chain step %r" % (step, ))
+        
+        for arg in list(args) + list(kwargs.values()):
+            if isinstance(arg, (list, dict)):
+                return ('copy', (args, kwargs))
+        return ('call', (args, kwargs))
+    
+    def run(self, steps):
+        """
+            Run steps against a new proxy and return the result
+
+            The result is the value from a command that bypasses the chain,
+            otherwise it is the current value on the chain
+        """
+        internals = ChainInternals(self.proxy_factory(), **self.options)
+        for index, (kind, value) in enumerate(steps):
+            if kind == 'use':
+                internals.use(value)
+            else:
+                if kind == 'copy':
+                    value = copy.deepcopy(value)
+                args, kwargs = value
+                val = internals.call_current(*args, **kwargs)
+                if val:
+                    if index != len(steps) - 1:
+                        raise ValueError("Chain script has steps after bypassing the chain")
+                    return val[0]
+        return internals.current_value
+    
+    def execute(self, lines, out):
+        """
+            Run each line from lines as a script and write a json line to out for each one
+
+            Lines are read and written one at a time so any amount of scripts can be run
+            Any error from a script is written out instead of it's result
+        """
+        for number, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line:
+                continue
+            
+            try:
+                output = {"line" : number, "result" : self.run(self.parse(line))}
+            except Exception as error:
+                output = {"line" : number, "error" : "%s: %s" % (error.__class__.__name__, error)}
+            
+            out.write(json.dumps(output, default=repr, sort_keys=True))
+            out.write("\n")
+            out.flush()
+
+def main(argv=None):
+    """Run json lines chain scripts from a file or stdin and write results to stdout"""
+    parser = argparse.ArgumentParser(description="Run json lines chain scripts")
+    parser.add_argument("factory"
+        , help = "module:name of a callable that makes a new proxy for each script"
+        )
+    parser.add_argument("scripts"
+        , nargs = "?"
+        , type = argparse.FileType('r')
+        , default = sys.stdin
+        , help = "File with one chain script per line (defaults to stdin)"
+        )
+    parser.add_argument("--not-strict"
+        , dest = "strict_proxy"
+        , action = "store_false"
+        , help = "Don't complain about attributes that don't exist on the proxy"
+        )
+    args = parser.parse_args(argv)
+    
+    module, _, name = args.factory.partition(":")
+    if not module or not name:
+        parser.error("factory must be in the form module:name, got %r" % args.factory)
+    factory = getattr(__import__(module, fromlist=[name]), name)
+    ChainScript(factory, strict_proxy=args.strict_proxy).execute(args.scripts, sys.stdout)
+
+if __name__ == '__main__':
+    main()
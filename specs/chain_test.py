@@ -1,8 +1,9 @@
 # coding: spec
 
-from chain import ChainAPI, ChainInternals, Chain
+from chain import ChainAPI, ChainInternals, Chain, ChainScript, ChainProfiler, ChainView, Description, deferrable
+
+from StringIO import StringIO
 
-from fudge import patched_context
 import fudge
 
 describe "ChainAPI":
@@ -180,6 +181,30 @@ describe "ChainInternals":
                 self.should_bypass(self.internals.exit)
                 self.internals.exit() |should| be(self.proxy)
         
+        describe "introspect":
+            it "bypasses the chain and returns the same view until the proxy changes":
+                self.should_bypass(self.internals.introspect)
+                view = self.internals.introspect()
+                view |should| be_instance_of(ChainView)
+                view.proxy |should| be(self.proxy)
+                self.internals.introspect() |should| be(view)
+                
+                self.internals.promote_value()
+                promoted = self.internals.introspect()
+                promoted |should_not| be(view)
+                promoted.proxy |should| be(self.current_value)
+                
+                self.internals.demote_value()
+                self.internals.introspect() |should_not| be(promoted)
+                self.internals.introspect().proxy |should| be(self.proxy)
+            
+            it "returns a new view when the proxy is set directly":
+                view = self.internals.introspect()
+                proxy2 = fudge.Fake("proxy2")
+                self.internals.proxy = proxy2
+                self.internals.introspect() |should_not| be(view)
+                self.internals.introspect().proxy |should| be(proxy2)
+        
         describe "get_stored":
             it "bypasses the chain and returns all stored values":
                 self.should_bypass(self.internals.get_stored)
@@ -238,6 +263,126 @@ describe "ChainInternals":
                 self.internals.setattr('a', value)
                 proxy.a |should| be(value)
         
+        describe "Transactions":
+            before_each:
+                class Obj(object):
+                    def __init__(self):
+                        self.a = 5
+                        self.called = []
+                    
+                    @deferrable
+                    def later(self, value):
+                        self.called.append((value, self.a))
+                    
+                    @deferrable
+                    def fail(self):
+                        raise ValueError("nope")
+                
+                self.obj = Obj()
+                self.internals.proxy = self.obj
+            
+            def call(self, key, *args, **kwargs):
+                self.internals.use(key)
+                return self.internals.call_current(*args, **kwargs)
+            
+            it "buffers setattrs and deferrable calls until commit":
+                self.should_not_bypass(self.internals.begin)
+                self.should_not_bypass(self.internals.commit)
+                self.internals.begin()
+                self.internals.setattr('a', 6)
+                self.call('later', 1)
+                self.obj.a |should| be(5)
+                self.obj.called |should| equal_to([])
+                
+                self.internals.commit()
+                self.obj.a |should| be(6)
+                self.obj.called |should| equal_to([(1, 6)])
+                self.internals.pending |should| be(None)
+            
+            it "only applies the last setattr for each attribute":
+                setattrs = []
+                class Watched(object):
+                    def __setattr__(s, key, value):
+                        setattrs.append((key, value))
+                        object.__setattr__(s, key, value)
+                
+                self.internals.proxy = Watched()
+                self.internals.begin()
+                self.internals.setattr('a', 1)
+                self.internals.setattr('b', 2)
+                self.internals.setattr('a', 3)
+                self.internals.commit()
+                setattrs |should| equal_to([('b', 2), ('a', 3)])
+            
+            it "leaves no current value after buffering a deferred call":
+                self.internals.begin()
+                self.call('later', 1)
+                self.internals.store('after')
+                self.internals.stored_values['after'] |should| be(None)
+                
+                self.internals.promote_value()
+                self.internals.proxy |should| be(None)
+            
+            it "profiles deferred calls under their own name when committed":
+                profiler = ChainProfiler()
+                self.internals.options['profiler'] = profiler
+                self.internals.begin()
+                self.call('later', 1)
+                self.internals.commit()
+                sorted(profiler.steps) |should| equal_to(['Obj.later'])
+            
+            it "does not coalesce setattrs across a deferred call":
+                self.internals.begin()
+                self.internals.setattr('a', 1)
+                self.call('later', 'first')
+                self.internals.setattr('a', 2)
+                self.internals.setattr('a', 3)
+                self.internals.commit()
+                self.obj.called |should| equal_to([('first', 1)])
+                self.obj.a |should| be(3)
+            
+            it "does not copy class attributes onto the instance when restoring":
+                type(self.obj).b = 1
+                self.internals.begin()
+                self.internals.setattr('b', 2)
+                self.call('fail')
+                ValueError |should| be_thrown_by(self.internals.commit)
+                self.obj.__dict__ |should_not| contain('b')
+                self.obj.b |should| be(1)
+            
+            it "raises the original error when restoring fails":
+                class Obj(object):
+                    def set_p(self, value):
+                        raise KeyError("original")
+                    p = property(None, set_p)
+                
+                self.internals.proxy = Obj()
+                self.internals.begin()
+                self.internals.setattr('p', 1)
+                KeyError |should| be_thrown_by(self.internals.commit)
+            
+            it "restores attributes that were set if anything fails":
+                self.internals.begin()
+                self.internals.setattr('a', 6)
+                self.internals.setattr('b', 7)
+                self.call('fail')
+                ValueError |should| be_thrown_by(self.internals.commit)
+                self.obj.a |should| be(5)
+                self.obj |should_not| respond_to('b')
+                self.internals.pending |should| be(None)
+            
+            it "can forget everything buffered":
+                self.internals.begin()
+                self.internals.setattr('a', 6)
+                self.internals.rollback()
+                self.obj.a |should| be(5)
+                self.internals.pending |should| be(None)
+            
+            it "complains about beginning twice or committing without beginning":
+                ValueError |should| be_thrown_by(self.internals.commit)
+                self.internals.begin()
+                ValueError |should| be_thrown_by(self.internals.begin)
+        
         describe "Proxy Management":
             it "can name the current proxy":
                 self.should_not_bypass(self.internals.name_proxy)
@@ -336,25 +481,35 @@ describe "Chain":
         
     describe "dir functionality":
         @fudge.test
-        it "returns list of chain_ prefixed results from dir on internals and everything from dir(proxy)":
-            proxy = fudge.Fake("proxy")
-            internals = fudge.Fake("internals")
-            internals.proxy = proxy
+        it "returns names from introspect on internals":
+            view = fudge.Fake("view").expects("names").returns(['chain_i1', 'p1'])
+            internals = fudge.Fake("internals").expects("introspect").returns(view)
             
             chain = Chain()
             chain.internals = internals
+            dir(chain) |should| equal_to(['chain_i1', 'p1'])
+        
+        it "returns chain_ prefixed names from internals and everything from the proxy":
+            class Thing(object):
+                def method(self):
+                    pass
+            thing = Thing()
+            thing.instance_attr = 1
             
-            original_dir = dir
-            def do_dir(obj):
-                if obj is proxy:
-                    return ['p1', 'p2', 'p3']
-                elif obj is internals:
-                    return ['i1', 'i2', 'i3']
-                else:
-                    return original_dir(obj)
-            
-            with patched_context("__builtin__", "dir", fudge.Fake("dir").expects_call().calls(do_dir)):
-                dir(chain) |should| equal_to(['chain_i1', 'chain_i2', 'chain_i3', 'p1', 'p2', 'p3'])
+            names = dir(Chain(thing))
+            for name in ('chain_exit', 'chain_store', 'chain_proxy', 'chain_options', 'chain_stored_values', 'method', 'instance_attr'):
+                names |should| contain(name)
+        
+        it "includes attributes set on the proxy through the chain":
+            class Thing(object):
+                pass
+            chain = Chain(Thing())
+            dir(chain) |should_not| contain('new_attr')
+            chain.chain_setattr('new_attr', 1)
+            dir(chain) |should| contain('new_attr')
+            
+            chain.chain_begin().chain_setattr('committed_attr', 1).chain_commit()
+            dir(chain) |should| contain('committed_attr')
     
     describe "Calling the chain":
         @fudge.test
@@ -384,4 +539,254 @@ describe "Chain":
             internals = fudge.Fake("internals").expects("call_current")
             internals.proxy = None
             chain.internals = internals
-            chain() |should| be(chain)
\ No newline at end of file
+            chain() |should| be(chain)
+
+describe "ChainView":
+    before_each:
+        class Thing(object):
+            @deferrable
+            def method(self):
+                pass
+        
+        self.thing = Thing()
+        self.thing.instance_attr = 1
+        self.view = ChainView(ChainInternals(), self.thing)
+    
+    it "describes chain commands with their flags":
+        self.view.commands['chain_exit'] |should| equal_to(Description(
+            callable=True, keep_current=True, bypass_chain=True, not_allowed_from_chain=False, deferrable=False
+            ))
+        self.view.commands['chain_use'].not_allowed_from_chain |should| be(True)
+        self.view.commands['chain_current'].callable |should| be(False)
+    
+    it "includes attributes on the internals instance as commands":
+        self.view.commands |should| contain('chain_proxy')
+        self.view.commands |should| contain('chain_options')
+        self.view.commands |should| contain('chain_stored_values')
+        self.view.commands |should| contain('chain_named_proxies')
+    
+    it "describes attributes on the proxy and it's instance":
+        self.view.attributes['method'] |should| equal_to(Description(
+            callable=True, keep_current=False, bypass_chain=False, not_allowed_from_chain=False, deferrable=True
+            ))
+        self.view.attributes['instance_attr'].callable |should| be(False)
+    
+    it "has no attributes without a proxy":
+        ChainView(ChainInternals(), None).attributes |should| equal_to({})
+    
+    it "shares descriptions of a type between views":
+        other = ChainView(ChainInternals(), type(self.thing)())
+        other.attributes['method'] |should| be(self.view.attributes['method'])
+    
+    it "doesn't let views change descriptions shared with other views":
+        AttributeError |should| be_thrown_by(lambda: setattr(self.view.attributes['method'], 'callable', False))
+        TypeError |should| be_thrown_by(lambda: self.view.attributes.__setitem__('method', None))
+        ChainView(ChainInternals(), type(self.thing)()).attributes['method'].callable |should| be(True)
+    
+    it "finds attributes added to the proxy or it's type after the view was made":
+        names = self.view.names()
+        self.thing.later_attr = 1
+        type(self.thing).later_method = lambda s: None
+        self.view.names() |should| contain('later_attr')
+        self.view.names() |should| contain('later_method')
+        self.view.attributes['later_method'].callable |should| be(True)
+    
+    it "lists names without accessing attributes":
+        class Dynamic(object):
+            def __dir__(self):
+                return ['broken']
+            
+            @property
+            def broken(self):
+                raise RuntimeError("Shouldn't be accessed")
+        
+        view = ChainView(ChainInternals(), Dynamic())
+        view.names() |should| contain('broken')
+        view.attributes['broken'].callable |should| be(False)
+    
+    it "finds attributes on proxies that are classes or old style instances":
+        class Old:
+            def meth(self):
+                pass
+        ChainView(ChainInternals(), Old()).names() |should| contain('meth')
+        ChainView(ChainInternals(), Old).names() |should| contain('meth')
+    
+    it "has names for everything":
+        names = self.view.names()
+        names |should| contain('chain_exit')
+        names |should| contain('method')
+        names |should| contain('instance_attr')
+
+describe "ChainProfiler":
+    before_each:
+        self.times = iter([0, 1, 3, 10, 20, 24])
+        self.profiler = ChainProfiler(timer=lambda: next(self.times))
+    
+    it "records calls, own time and total time for each step":
+        self.profiler.call("one", lambda a: a + 1, 1) |should| be(2)
+        self.profiler.steps |should| equal_to({"one" : [1, 1, 1, 1, {}]})
+    
+    it "records steps inside other steps under them":
+        def outer():
+            self.profiler.call("inner", lambda: None)
+            self.profiler.call("inner", lambda: None)
+        self.profiler.call("outer", outer)
+        
+        self.profiler.steps['outer'] |should| equal_to([1, 1, 12, 24, {}])
+        self.profiler.steps['inner'] |should| equal_to([2, 2, 12, 12, {'outer' : [2, 2, 12, 12]}])
+        self.profiler.collapsed |should| equal_to({'outer' : 12, 'outer;inner' : 12})
+    
+    it "only counts total time once for steps that call themselves":
+        def recurse(n):
+            if n:
+                self.profiler.call("rec", recurse, n - 1)
+        self.profiler.call("rec", recurse, 2)
+        
+        # Timer goes 0, 1, 3 in and 10, 20, 24 out
+        self.profiler.steps['rec'] |should| equal_to([3, 1, 24, 24, {'rec' : [2, 0, 19, 0]}])
+        self.profiler.create_stats()
+        self.profiler.stats[("chain", 0, "rec")][:4] |should| equal_to((1, 3, 24, 24))
+    
+    it "keeps a separate stack of steps for each thread":
+        import threading
+        stacks = []
+        thread = threading.Thread(target=lambda: stacks.append(list(self.profiler.stack)))
+        
+        def outer():
+            thread.start()
+            thread.join()
+        self.profiler.call("outer", outer)
+        stacks |should| equal_to([[]])
+    
+    it "creates stats in the same format as cProfile":
+        def outer():
+            self.profiler.call("inner", lambda: None)
+        self.profiler.call("outer", outer)
+        self.profiler.create_stats()
+        self.profiler.stats |should| equal_to(
+            { ("chain", 0, "outer") : (1, 1, 8, 10, {})
+            , ("chain", 0, "inner") : (1, 1, 2, 2, {("chain", 0, "outer") : (1, 1, 2, 2)})
+            }
+        )
+    
+    it "writes collapsed stacks in microseconds":
+        def outer():
+            self.profiler.call("inner", lambda: None)
+        self.profiler.call("outer", outer)
+        out = StringIO()
+        self.profiler.write_collapsed(out)
+        out.getvalue() |should| equal_to("outer 8000000\nouter;inner 2000000\n")
+    
+    it "is used by the chain to name steps after the proxy type and method":
+        class Thing(object):
+            def method(self):
+                pass
+        (Chain(Thing(), profiler=self.profiler)
+            .method()
+            .chain_store('a')
+            )
+        sorted(self.profiler.steps) |should| equal_to(['Thing.method', 'chain_store'])
+    
+    it "names steps after what is actually called":
+        class Thing(object):
+            def __call__(self):
+                pass
+            
+            def method(self):
+                def returned():
+                    pass
+                return returned
+        (Chain(Thing(), profiler=self.profiler)
+            .method()()
+            .chain_call_proxy()()
+            )
+        sorted(self.profiler.steps) |should| equal_to(['Thing.__call__', 'Thing.method', 'chain_call_proxy', 'returned'])
+    
+    it "names steps on a class proxy after the class":
+        class Thing(object):
+            @classmethod
+            def create(cls):
+                pass
+            
+            @staticmethod
+            def static():
+                pass
+        (Chain(Thing, profiler=self.profiler)
+            .create()
+            .static()
+            )
+        sorted(self.profiler.steps) |should| equal_to(['Thing.create', 'Thing.static'])
+    
+    it "doesn't make naming steps a chain command":
+        dir(Chain()) |should_not| contain('chain_step_name')
+
+describe "ChainScript":
+    before_each:
+        self.proxy = type('test', (object, ), dict(one=lambda s, *args, **kwargs: (args, kwargs)))()
+        self.script = ChainScript(lambda: self.proxy)
+    
+    describe "Parsing":
+        it "turns strings into use steps and lists and dictionaries into call steps":
+            self.script.parse('["one", [1, 2], {"args" : [3], "kwargs" : {"a" : 4}}]') |should| equal_to(
+                ( ('use', 'one')
+                , ('call', ((1, 2), {}))
+                , ('call', ((3, ), {'a' : 4}))
+                )
+            )
+        
+        it "complains about scripts that aren't a list of known steps":
+            ValueError |should| be_thrown_by(lambda: self.script.parse('{"one" : 1}'))
+            ValueError |should| be_thrown_by(lambda: self.script.parse('["one", 1]'))
+        
+        it "complains about call steps with the wrong args, kwargs or other keys":
+            ValueError |should| be_thrown_by(lambda: self.script.parse('[{"args" : "ab"}]'))
+            ValueError |should| be_thrown_by(lambda: self.script.parse('[{"kwargs" : []}]'))
+            ValueError |should| be_thrown_by(lambda: self.script.parse('[{"args" : [], "other" : 1}]'))
+        
+        it "marks calls with lists or dictionaries in their arguments to be copied":
+            self.script.parse('[[[1]], {"kwargs" : {"a" : {}}}]') |should| equal_to(
+                ( ('copy', (([1], ), {}))
+                , ('copy', ((), {'a' : {}}))
+                )
+            )
+        
+        it "reuses steps for identical scripts":
+            steps = self.script.parse('["one", []]')
+            self.script.parse('["one", []]') |should| be(steps)
+        
+        it "forgets the least recently used script when the cache is full":
+            self.script.cache_size = 2
+            self.script.parse('["one", [1]]')
+            self.script.parse('["one", [2]]')
+            self.script.parse('["one", [1]]')
+            self.script.parse('["one", [3]]')
+            list(self.script.parsed.keys()) |should| equal_to(['["one", [1]]', '["one", [3]]'])
+    
+    describe "Running":
+        it "returns the current value on the chain":
+            self.script.run(self.script.parse('["one", [1], "one", {"kwargs" : {"a" : 2}}]')) |should| equal_to(((), {'a' : 2}))
+        
+        it "returns the value from commands that bypass the chain":
+            self.script.run(self.script.parse('["chain_exit", []]')) |should| be(self.proxy)
+        
+        it "gives each run it's own copy of list and dictionary arguments":
+            class Adder(object):
+                def add(self, things):
+                    things.append(1)
+                    return len(things)
+            script = ChainScript(Adder)
+            steps = script.parse('["add", [[]]]')
+            script.run(steps) |should| be(1)
+            script.run(steps) |should| be(1)
+        
+        it "complains if there are steps after bypassing the chain":
+            ValueError |should| be_thrown_by(lambda: self.script.run(self.script.parse('["chain_exit", [], "one"]')))
+    
+    describe "Executing":
+        it "writes a json line with the result or error for each line":
+            out = StringIO()
+            self.script.execute(['["one", [1]]\n', '\n', '["two", []]\n'], out)
+            out.getvalue() |should| equal_to(
+                  '{"line": 1, "result": [[1], {}]}\n'
+                + '{"error": "AttributeError: Proxy (%s) does not have two", "line": 3}\n' % self.proxy
+                )